@@ -4,9 +4,11 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
 import json
+import math
 import os
 import random
 import signal
@@ -15,6 +17,8 @@ import time
 import urllib
 
 from torch import nn, optim
+from torch.distributed.optim import ZeroRedundancyOptimizer
+import torch.nn.functional as F
 from torchvision import models, datasets, transforms
 import torch
 import torchvision
@@ -32,8 +36,8 @@ parser.add_argument('--weights', default='freeze', type=str,
 parser.add_argument('--train-percent', default=100, type=int,
                     choices=(100, 10, 1),
                     help='size of traing set in percent')
-parser.add_argument('--workers', default=2, type=int, metavar='N',
-                    help='number of data loader workers')
+parser.add_argument('--workers', default=None, type=int, metavar='N',
+                    help='number of data loader workers (default: min(8, cpus per gpu))')
 parser.add_argument('--epochs', default=100, type=int, metavar='N',
                     help='number of total epochs to run')
 parser.add_argument('--batch-size', default=256, type=int, metavar='N',
@@ -50,6 +54,20 @@ parser.add_argument('--checkpoint-dir', default='./checkpoint/lincls/', type=Pat
                     metavar='DIR', help='path to checkpoint directory')
 parser.add_argument('--encoder', default='resnet50', type=str, choices=('resnet18', 'resnet34', 'resnet50'),
                     help="encoder backbone model")
+parser.add_argument('--feature-copies', default=5, type=int, metavar='N',
+                    help='number of augmented copies of the training set features cached in freeze mode')
+parser.add_argument('--nccl-channels', default=None, type=int, metavar='N',
+                    help='cap NCCL to N channels, i.e. SMs used for communication (NCCL_*_NCHANNELS); '
+                         'can help the small resnet18/34 models, NCCL decides by default')
+parser.add_argument('--amp', action='store_true',
+                    help='use automatic mixed precision')
+parser.add_argument('--bf16', action='store_true',
+                    help='use bfloat16 (Ampere or newer): the frozen backbone is cast to bfloat16, '
+                         'finetuning keeps fp32 weights and autocasts the forward to bfloat16')
+parser.add_argument('--compile', action='store_true',
+                    help='compile the model with torch.compile')
+parser.add_argument('--cuda-graphs', action='store_true',
+                    help='capture the forward and backward pass of the training step in cuda graphs')
 
 cifar_mean = {
     'cifar10': (0.4914, 0.4822, 0.4465),
@@ -64,7 +82,13 @@ cifar_std = {
 
 def main():
     args = parser.parse_args()
+    if args.compile and args.cuda_graphs:
+        parser.error('--cuda-graphs cannot be combined with --compile')
+    if args.amp and args.bf16:
+        parser.error('--bf16 cannot be combined with --amp')
     args.ngpus_per_node = torch.cuda.device_count()
+    if args.workers is None:
+        args.workers = min(8, os.cpu_count() // args.ngpus_per_node)
     if 'SLURM_JOB_ID' in os.environ:
         signal.signal(signal.SIGUSR1, handle_sigusr1)
         signal.signal(signal.SIGTERM, handle_sigterm)
@@ -77,10 +101,19 @@ def main():
 
 def main_worker(gpu, args):
     args.rank += gpu
+    if args.nccl_channels is not None:
+        # small models leave little compute to overlap NCCL with, so its SM budget can be capped;
+        # variables already set in the environment take precedence
+        os.environ.setdefault('NCCL_MIN_NCHANNELS', str(args.nccl_channels))
+        os.environ.setdefault('NCCL_MAX_NCHANNELS', str(args.nccl_channels))
+    if args.weights == 'freeze':
+        # only the linear head is all-reduced, tree beats ring on such small messages
+        os.environ.setdefault('NCCL_ALGO', 'Tree')
     torch.distributed.init_process_group(
         backend='nccl', init_method=args.dist_url,
         world_size=args.world_size, rank=args.rank)
 
+    stats_file = None
     if args.rank == 0:
         args.checkpoint_dir.mkdir(parents=True, exist_ok=True)
         stats_file = open(args.checkpoint_dir / 'stats.txt', 'a', buffering=1)
@@ -99,13 +132,25 @@ def main_worker(gpu, args):
     else:
         model = models.resnet50(num_classes = num_classes).cuda(gpu)
 
-    state_dict = torch.load(args.pretrained, map_location='cpu')
+    # mapped rather than read, the tensors are only paged in by load_state_dict below
+    state_dict = torch.load(args.pretrained, map_location='cpu', mmap=True, weights_only=True)
     missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
     assert missing_keys == ['fc.weight', 'fc.bias'] and unexpected_keys == []
+    # NHWC lets cudnn pick tensor core kernels without internal transposes
+    model = model.to(memory_format=torch.channels_last)
 
     model.fc.weight.data.normal_(mean=0.0, std=0.01)
     model.fc.bias.data.zero_()
+    if args.bf16 and args.weights == 'freeze':
+        # the frozen backbone is never updated, so it runs entirely in bf16 without per-op
+        # casts; the trained linear head stays fp32. Finetuning keeps fp32 master weights
+        # and momentum instead, since bf16 would round small sgd updates away, see autocast()
+        model = model.to(torch.bfloat16)
+        model.fc.float()
     if args.weights == 'freeze':
+        # checksummed once here so the per-epoch sanity check needs no reload or copy
+        reference_keys = list(state_dict)
+        reference_checksum = state_dict_checksum(model.state_dict(), reference_keys)
         model.requires_grad_(False)
         model.fc.requires_grad_(True)
     classifier_parameters, model_parameters = [], []
@@ -114,26 +159,73 @@ def main_worker(gpu, args):
             classifier_parameters.append(param)
         else:
             model_parameters.append(param)
-    model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[gpu])
+    if args.weights == 'freeze':
+        # only the linear head is trained, so the backbone is kept out of DDP
+        # and is used once to extract features on every rank
+        backbone = model
+        model = backbone.fc
+        backbone.fc = nn.Identity()
+    if args.cuda_graphs:
+        # forward and backward are replayed from cuda graphs, while DDP's all-reduce and the
+        # optimizer step stay eager since the lr and the grad scale change between steps;
+        # the graphs need a static batch, so the last partial training batch is dropped
+        batch_size = args.batch_size // args.world_size
+        if args.weights == 'freeze':
+            sample = torch.randn(batch_size, model.in_features, device='cuda')
+        else:
+            sample = torch.randn(batch_size, 3, 32, 32, device='cuda', dtype=torch.bfloat16 if args.bf16 else torch.float32)
+            sample = sample.contiguous(memory_format=torch.channels_last)
+        # the capture warmup runs must not leak into the batch norm statistics
+        buffers = [b.clone() for b in model.buffers()]
+        with autocast(args, cache_enabled=False):
+            model = torch.cuda.make_graphed_callables(model, (sample,))
+        for b, saved in zip(model.buffers(), buffers):
+            b.copy_(saved)
+    model = torch.nn.parallel.DistributedDataParallel(
+        model, device_ids=[gpu], find_unused_parameters=False, gradient_as_bucket_view=True)
+    if args.compile:
+        # compiled in place so that state_dict keys stay the same with and without --compile
+        model.compile(mode='max-autotune')
+        if args.weights == 'freeze':
+            # static input shapes, so the feature extraction can replay cuda graphs
+            backbone.compile(mode='reduce-overhead')
 
     criterion = nn.CrossEntropyLoss().cuda(gpu)
 
     param_groups = [dict(params=classifier_parameters, lr=args.lr_classifier)]
     if args.weights == 'finetune':
         param_groups.append(dict(params=model_parameters, lr=args.lr_backbone))
-    optimizer = optim.SGD(param_groups, 0, momentum=0.9, weight_decay=args.weight_decay)
+        # the backbone momentum buffers are sharded across ranks instead of replicated;
+        # no bucket views, they would rebind param.data to flat storage, dropping the
+        # channels_last layout and leaving captured cuda graphs reading freed weights
+        optimizer = ZeroRedundancyOptimizer(
+            param_groups, optimizer_class=optim.SGD, parameters_as_bucket_view=False,
+            lr=0, momentum=0.9, weight_decay=args.weight_decay)
+    else:
+        optimizer = optim.SGD(param_groups, 0, momentum=0.9, weight_decay=args.weight_decay)
     scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, args.epochs)
+    # loss scaling is only needed when gradients flow through the fp16 backbone
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and args.weights == 'finetune')
 
     # automatically resume from checkpoint if it exists
     if (args.checkpoint_dir / 'checkpoint.pth').is_file():
+        # not weights_only, the checkpoint pickles the best accuracies as argparse.Namespace
         ckpt = torch.load(args.checkpoint_dir / 'checkpoint.pth',
-                          map_location='cpu')
+                          map_location='cpu', mmap=True, weights_only=False)
         start_epoch = ckpt['epoch']
         best_val_acc = ckpt['best_val_acc']
         best_test_acc = ckpt['best_test_acc']
-        model.load_state_dict(ckpt['model'])
+        if args.weights == 'freeze':
+            # the backbone is the pretrained one checked above, only the head is restored
+            model.module.load_state_dict({
+                k[len('module.fc.'):]: v for k, v in ckpt['model'].items() if k.startswith('module.fc.')})
+        else:
+            model.load_state_dict(ckpt['model'])
         optimizer.load_state_dict(ckpt['optimizer'])
         scheduler.load_state_dict(ckpt['scheduler'])
+        # missing from older checkpoints and empty when saved with the scaler disabled
+        if ckpt.get('scaler'):
+            scaler.load_state_dict(ckpt['scaler'])
     else:
         start_epoch = 0
         best_val_acc = argparse.Namespace(top1=0, top5=0)
@@ -141,20 +233,13 @@ def main_worker(gpu, args):
 
     # DATASET
 
-    normalize = transforms.Normalize(mean=cifar_mean[args.dataset], std=cifar_std[args.dataset])
-
-    train_transform = transforms.Compose([
-            transforms.RandomResizedCrop(32),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-    ])
+    # images stay uint8 until they reach the gpu, see CIFARTensorDataset and PrefetchLoader;
+    # training crops and flips are applied there to the whole batch by RandomResizedCropFlip
+    augment = RandomResizedCropFlip(32)
 
     test_transform = transforms.Compose([
-            transforms.Resize(36),
+            transforms.Resize(36, antialias=True),
             transforms.CenterCrop(32),
-            transforms.ToTensor(),
-            normalize,
     ])
 
     if args.dataset == 'cifar10':
@@ -162,14 +247,18 @@ def main_worker(gpu, args):
     else:
         dataset = torchvision.datasets.CIFAR100
 
-    train_dataset = dataset(args.data / 'train', download=True, train=True, transform=train_transform)
-    val_dataset = dataset(args.data / 'train', download=True, train=True, transform=test_transform)
+    train_data = dataset(args.data / 'train', download=True, train=True)
+    train_images = torch.from_numpy(train_data.data).permute(0, 3, 1, 2).contiguous()
+    train_targets = torch.tensor(train_data.targets)
+    train_dataset = CIFARTensorDataset(train_images, train_targets)
+    val_dataset = CIFARTensorDataset(train_images, train_targets, transform=test_transform)
     
     # split in train and val
     seed = 10
     num_train = int( args.train_percent * len(train_dataset) / 100 )
-    train_idx = list(range(len(train_dataset)))
-    random.Random(seed).shuffle(train_idx)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    train_idx = torch.randperm(len(train_dataset), generator=generator).tolist()
     num_val = int(0.1 * num_train)
     num_train = num_train - num_val
     val_idx = train_idx[num_train:]
@@ -178,93 +267,132 @@ def main_worker(gpu, args):
     val_dataset = torch.utils.data.Subset(val_dataset, val_idx)
     train_dataset = torch.utils.data.Subset(train_dataset, train_idx)
 
-    test_dataset = dataset(args.data / 'test', download=True, train=False, transform=test_transform)
+    test_data = dataset(args.data / 'test', download=True, train=False)
+    test_dataset = CIFARTensorDataset(torch.from_numpy(test_data.data).permute(0, 3, 1, 2).contiguous(),
+                                      torch.tensor(test_data.targets), transform=test_transform)
 
     train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
     kwargs = dict(batch_size=args.batch_size // args.world_size, num_workers=args.workers, pin_memory=True)
-    train_loader = torch.utils.data.DataLoader(train_dataset, sampler=train_sampler, **kwargs)
-    val_loader = torch.utils.data.DataLoader(val_dataset, **kwargs)
-    test_loader = torch.utils.data.DataLoader(test_dataset, **kwargs)
+    if args.workers > 0:
+        # keep the workers alive across epochs instead of respawning them
+        kwargs.update(persistent_workers=True, prefetch_factor=4)
+    drop_last = args.cuda_graphs and args.weights == 'finetune'
+    train_loader = torch.utils.data.DataLoader(train_dataset, sampler=train_sampler, drop_last=drop_last, **kwargs)
+    # every rank evaluates its own shard, the samplers pad the shards to equal
+    # length and evaluate() skips those trailing duplicates
+    val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+    test_sampler = torch.utils.data.distributed.DistributedSampler(test_dataset, shuffle=False)
+    num_val_samples = len(range(args.rank, len(val_dataset), args.world_size))
+    num_test_samples = len(range(args.rank, len(test_dataset), args.world_size))
+    val_loader = torch.utils.data.DataLoader(val_dataset, sampler=val_sampler, **kwargs)
+    test_loader = torch.utils.data.DataLoader(test_dataset, sampler=test_sampler, **kwargs)
+
+    mean, std = cifar_mean[args.dataset], cifar_std[args.dataset]
+    dtype = torch.bfloat16 if args.bf16 else torch.float32
+    train_loader = PrefetchLoader(train_loader, mean, std, transform=augment, dtype=dtype)
+    val_loader = PrefetchLoader(val_loader, mean, std, dtype=dtype)
+    test_loader = PrefetchLoader(test_loader, mean, std, dtype=dtype)
+
+    if args.weights == 'freeze':
+        # the frozen backbone is deterministic, so its features are computed once and
+        # the linear head is trained on them, cycling through augmented training copies
+        backbone.eval()
+        batch_size = args.batch_size // args.world_size
+        features, targets = extract_features(backbone, train_loader, args, copies=args.feature_copies)
+        train_loader = FeatureLoader(features, targets, batch_size, shuffle=True, drop_last=args.cuda_graphs)
+        features, targets = extract_features(backbone, val_loader, args)
+        val_loader = FeatureLoader(features, targets, batch_size)
+        features, targets = extract_features(backbone, test_loader, args)
+        test_loader = FeatureLoader(features, targets, batch_size)
+
+    if args.rank == 0:
+        # checkpoints are written by a background thread while training continues
+        saver = ThreadPoolExecutor(max_workers=1)
+        pending_save = None
 
     start_time = time.time()
     for epoch in range(start_epoch, args.epochs):
         # train
-        if args.weights == 'finetune':
-            model.train()
-        elif args.weights == 'freeze':
-            model.eval()
-        else:
-            assert False
+        model.train()
         train_sampler.set_epoch(epoch)
+        pending_loss = None
         for step, (images, target) in enumerate(train_loader, start=epoch * len(train_loader)):
-            output = model(images.cuda(gpu, non_blocking=True))
-            loss = criterion(output, target.cuda(gpu, non_blocking=True))
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with autocast(args):
+                output = model(images)
+                loss = criterion(output.float(), target)
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             if step % args.print_freq == 0:
-                torch.distributed.reduce(loss.div_(args.world_size), 0)
-                if args.rank == 0:
-                    pg = optimizer.param_groups
-                    lr_classifier = pg[0]['lr']
-                    lr_backbone = pg[1]['lr'] if len(pg) == 2 else 0
-                    stats = dict(epoch=epoch, step=step, lr_backbone=lr_backbone,
-                                 lr_classifier=lr_classifier, loss=loss.item(),
-                                 time=int(time.time() - start_time))
-                    print(json.dumps(stats))
-                    print(json.dumps(stats), file=stats_file)
+                # the loss is reduced asynchronously and only read back at the next print step
+                if pending_loss is not None:
+                    log_loss(pending_loss, args, stats_file)
+                pg = optimizer.param_groups
+                lr_classifier = pg[0]['lr']
+                lr_backbone = pg[1]['lr'] if len(pg) == 2 else 0
+                stats = dict(epoch=epoch, step=step, lr_backbone=lr_backbone,
+                             lr_classifier=lr_classifier, time=int(time.time() - start_time))
+                reduced_loss = loss.detach() / args.world_size
+                handle = torch.distributed.all_reduce(reduced_loss, async_op=True)
+                pending_loss = (handle, reduced_loss, stats)
+        if pending_loss is not None:
+            log_loss(pending_loss, args, stats_file)
 
         # evaluate
         model.eval()
+        # valdation
+        val_acc1, val_acc5 = evaluate(model, val_loader, num_val_samples, args)
+
+        #test
+        test_acc1, test_acc5 = evaluate(model, test_loader, num_test_samples, args)
+
         if args.rank == 0:
-            # valdation
-            val_top1 = AverageMeter('ValAcc@1')
-            val_top5 = AverageMeter('ValAcc@5')
-            with torch.no_grad():
-                for images, target in val_loader:
-                    output = model(images.cuda(gpu, non_blocking=True))
-                    acc1, acc5 = accuracy(output, target.cuda(gpu, non_blocking=True), topk=(1, 5))
-                    val_top1.update(acc1[0].item(), images.size(0))
-                    val_top5.update(acc5[0].item(), images.size(0))
-            
-            #test
-            test_top1 = AverageMeter('TestAcc@1')
-            test_top5 = AverageMeter('TestAcc@5')
-            with torch.no_grad():
-                for images, target in test_loader:
-                    output = model(images.cuda(gpu, non_blocking=True))
-                    acc1, acc5 = accuracy(output, target.cuda(gpu, non_blocking=True), topk=(1, 5))
-                    test_top1.update(acc1[0].item(), images.size(0))
-                    test_top5.update(acc5[0].item(), images.size(0))
-
-            #best_val_acc.top1 = max(best_val_acc.top1, val_top1.avg)
-            best_val_acc.top5 = max(best_val_acc.top5, val_top5.avg)
-            if val_top1.avg > best_val_acc.top1: 
-                best_val_acc.top1 = val_top1.avg
+            #best_val_acc.top1 = max(best_val_acc.top1, val_acc1)
+            best_val_acc.top5 = max(best_val_acc.top5, val_acc5)
+            if val_acc1 > best_val_acc.top1: 
+                best_val_acc.top1 = val_acc1
                 # keeping test_acc at the maximum val top1 acc
-                best_test_acc.top1 = max(best_test_acc.top1, test_top1.avg)
-                best_test_acc.top5 = max(best_test_acc.top5, test_top5.avg)
+                best_test_acc.top1 = max(best_test_acc.top1, test_acc1)
+                best_test_acc.top5 = max(best_test_acc.top5, test_acc5)
             
             # dump epoch stats
             stats = dict(epoch=epoch, 
-                        val_acc1=val_top1.avg, val_acc5=val_top5.avg, best_val_acc1=best_val_acc.top1, best_val_acc5=best_test_acc.top5,
-                        test_acc1=test_top1.avg, test_acc5=test_top5.avg, best_test_acc1=best_test_acc.top1, best_test_acc5=best_test_acc.top5)
+                        val_acc1=val_acc1, val_acc5=val_acc5, best_val_acc1=best_val_acc.top1, best_val_acc5=best_test_acc.top5,
+                        test_acc1=test_acc1, test_acc5=test_acc5, best_test_acc1=best_test_acc.top1, best_test_acc5=best_test_acc.top5)
             print(json.dumps(stats))
             print(json.dumps(stats), file=stats_file)
 
         # sanity check
         if args.weights == 'freeze':
-            reference_state_dict = torch.load(args.pretrained, map_location='cpu')
-            model_state_dict = model.module.state_dict()
-            for k in reference_state_dict:
-                assert torch.equal(model_state_dict[k].cpu(), reference_state_dict[k]), k
+            checksum = state_dict_checksum(backbone.state_dict(), reference_keys)
+            assert torch.equal(checksum, reference_checksum), [
+                k for k, a, b in zip(reference_keys, checksum.tolist(), reference_checksum.tolist()) if a != b]
 
         scheduler.step()
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            # collective, gathers the optimizer shards on rank 0 for the checkpoint
+            optimizer.consolidate_state_dict(to=0)
         if args.rank == 0:
+            if args.weights == 'freeze':
+                # same keys as the DDP-wrapped full resnet: backbone plus the head under fc
+                model_state = {'module.' + k: v for k, v in backbone.state_dict().items()}
+                model_state.update({'module.fc.' + k: v for k, v in model.module.state_dict().items()})
+            else:
+                model_state = model.state_dict()
             state = dict(
                 epoch=epoch + 1, best_val_acc=best_val_acc, best_test_acc=best_test_acc,
-                model=model.state_dict(), optimizer=optimizer.state_dict(), scheduler=scheduler.state_dict())
-            torch.save(state, args.checkpoint_dir / 'checkpoint.pth')
+                model=model_state, optimizer=optimizer.state_dict(), scheduler=scheduler.state_dict(),
+                scaler=scaler.state_dict())
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = save_checkpoint_async(saver, state, args.checkpoint_dir / 'checkpoint.pth')
+
+    if args.rank == 0:
+        # re-raises a failure of the final save instead of silently dropping it
+        if pending_save is not None:
+            pending_save.result()
+        saver.shutdown(wait=True)
 
 
 def handle_sigusr1(signum, frame):
@@ -276,45 +404,219 @@ def handle_sigterm(signum, frame):
     pass
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self, name, fmt=':f'):
-        self.name = name
-        self.fmt = fmt
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-    def __str__(self):
-        fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
+def autocast(args, **kwargs):
+    """Mixed precision context, fp16 with --amp and bf16 when finetuning with --bf16"""
+    enabled = args.amp or (args.bf16 and args.weights == 'finetune')
+    dtype = torch.bfloat16 if args.bf16 else torch.float16
+    return torch.cuda.amp.autocast(enabled=enabled, dtype=dtype, **kwargs)
+
+
+def checkpoint_to_cpu(obj):
+    """Recursively copies the tensors of a checkpoint to the cpu without blocking"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', non_blocking=True)
+    if isinstance(obj, dict):
+        return {k: checkpoint_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(checkpoint_to_cpu(v) for v in obj)
+    if isinstance(obj, argparse.Namespace):
+        return argparse.Namespace(**checkpoint_to_cpu(vars(obj)))
+    return obj
+
+
+def write_checkpoint(state, path, copied):
+    copied.synchronize()
+    # written next to the old checkpoint and renamed, so a requeue never sees a partial file
+    tmp_path = path.with_suffix('.tmp')
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint_async(saver, state, path):
+    """Snapshots the state to the cpu on a side stream and writes it on the saver thread"""
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        state = checkpoint_to_cpu(state)
+    copied = torch.cuda.Event()
+    copied.record(stream)
+    # the next optimizer steps update the weights in place, so they wait for the copies
+    torch.cuda.current_stream().wait_stream(stream)
+    return saver.submit(write_checkpoint, state, path, copied)
+
+
+def evaluate(model, loader, num_samples, args):
+    """Returns the top-1 and top-5 accuracy over all ranks, counting only the first
+    num_samples samples of this rank's shard and reading the gpu counters back once"""
+    count = 0
+    with torch.inference_mode(), autocast(args):
+        correct1 = torch.zeros((), device='cuda')
+        correct5 = torch.zeros((), device='cuda')
+        for images, target in loader:
+            output = model(images)
+            n = min(target.size(0), num_samples - count)
+            c1, c5 = accuracy(output[:n], target[:n], topk=(1, 5))
+            correct1 += c1
+            correct5 += c5
+            count += n
+    totals = torch.stack([correct1, correct5, torch.tensor(float(count), device='cuda')])
+    torch.distributed.all_reduce(totals)
+    acc1, acc5 = (totals[:2] * 100.0 / totals[2]).tolist()
+    return acc1, acc5
+
+
+class CIFARTensorDataset(torch.utils.data.Dataset):
+    """Serves decoded uint8 NCHW images straight from memory, bypassing PIL"""
+    def __init__(self, images, targets, transform=None):
+        self.images = images
+        self.targets = targets
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        image = self.images[index]
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+
+class RandomResizedCropFlip(nn.Module):
+    """Batched gpu equivalent of RandomResizedCrop followed by RandomHorizontalFlip"""
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3)):
+        super().__init__()
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+
+    def forward(self, x):
+        n = x.size(0)
+        area = torch.empty(n, device=x.device).uniform_(*self.scale)
+        ratio = torch.empty(n, device=x.device).uniform_(*self.log_ratio).exp_()
+        # crop size and center in the [-1, 1] coordinates of affine_grid
+        w = (area * ratio).sqrt_().clamp_(max=1)
+        h = (area / ratio).sqrt_().clamp_(max=1)
+        cx = (torch.rand(n, device=x.device) * 2 - 1) * (1 - w)
+        cy = (torch.rand(n, device=x.device) * 2 - 1) * (1 - h)
+        # a negative x scale mirrors the crop around its center
+        flip = 1 - 2 * (torch.rand(n, device=x.device) < 0.5).float()
+
+        theta = torch.zeros(n, 2, 3, device=x.device)
+        theta[:, 0, 0] = w * flip
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = cy
+        grid = F.affine_grid(theta.to(x.dtype), (n, x.size(1), self.size, self.size), align_corners=False)
+        x = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        return x.contiguous(memory_format=torch.channels_last)
+
+
+def log_loss(pending_loss, args, stats_file):
+    """Waits for an all-reduced training loss and logs it together with its step stats"""
+    handle, loss, stats = pending_loss
+    handle.wait()
+    if args.rank == 0:
+        stats['loss'] = loss.item()
+        print(json.dumps(stats))
+        print(json.dumps(stats), file=stats_file)
+
+
+def state_dict_checksum(state_dict, keys):
+    """Sums each tensor in double precision, on the device it lives on"""
+    return torch.stack([state_dict[k].double().sum() for k in keys])
+
+
+def extract_features(backbone, loader, args, copies=1):
+    """Runs the frozen backbone over the loader and returns pinned (copies, N, D) features"""
+    features, targets = [], []
+    # no autograd bookkeeping at all, stacking outside the block turns the results into normal tensors
+    with torch.inference_mode(), autocast(args):
+        for _ in range(copies):
+            copy_features, copy_targets = [], []
+            for images, target in loader:
+                # copied because compiled cuda graphs reuse their output buffers
+                copy_features.append(backbone(images).to(torch.float32, copy=True))
+                copy_targets.append(target)
+            features.append(torch.cat(copy_features).cpu())
+            targets.append(torch.cat(copy_targets).cpu())
+    return torch.stack(features).pin_memory(), torch.stack(targets)
+
+
+class FeatureLoader(object):
+    """Serves batches of cached features, moving to the next cached copy every epoch"""
+    def __init__(self, features, targets, batch_size, shuffle=False, drop_last=False):
+        self.features = features
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.copy = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return self.targets.size(1) // self.batch_size
+        return math.ceil(self.targets.size(1) / self.batch_size)
+
+    def __iter__(self):
+        features = self.features[self.copy].cuda(non_blocking=True)
+        targets = self.targets[self.copy].cuda(non_blocking=True)
+        self.copy = (self.copy + 1) % len(self.features)
+        if self.shuffle:
+            perm = torch.randperm(len(targets), device=targets.device)
+            features, targets = features[perm], targets[perm]
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            yield features[i:i + self.batch_size], targets[i:i + self.batch_size]
+
+
+class PrefetchLoader(object):
+    """Copies uint8 batches to the gpu, normalizes and optionally transforms them on
+    a side stream while the previous batch is consumed on the current stream"""
+    def __init__(self, loader, mean, std, transform=None, dtype=torch.float32):
+        self.loader = loader
+        self.mean = torch.tensor([m * 255 for m in mean]).cuda().view(1, 3, 1, 1)
+        self.std = torch.tensor([s * 255 for s in std]).cuda().view(1, 3, 1, 1)
+        self.transform = transform
+        self.dtype = dtype
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        first = True
+        for next_images, next_target in self.loader:
+            with torch.cuda.stream(self.stream):
+                next_images = next_images.cuda(non_blocking=True)
+                next_target = next_target.cuda(non_blocking=True)
+                next_images = next_images.contiguous(memory_format=torch.channels_last)
+                next_images = next_images.float().sub_(self.mean).div_(self.std)
+                if self.transform is not None:
+                    next_images = self.transform(next_images)
+                next_images = next_images.to(self.dtype)
+            if not first:
+                yield images, target
+            first = False
+            torch.cuda.current_stream().wait_stream(self.stream)
+            # allocated on the side stream but freed after use on the current one
+            next_images.record_stream(torch.cuda.current_stream())
+            next_target.record_stream(torch.cuda.current_stream())
+            images, target = next_images, next_target
+        if not first:
+            yield images, target
 
 
 def accuracy(output, target, topk=(1,)):
-    """Computes the accuracy over the k top predictions for the specified values of k"""
+    """Counts the correct predictions among the k top predictions for the specified values of k"""
     with torch.no_grad():
         maxk = max(topk)
-        batch_size = target.size(0)
-
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
+        if maxk == 1:
+            return [output.argmax(1).eq(target).sum(dtype=torch.float32)]
 
-        res = []
-        for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(100.0 / batch_size))
-        return res
+        # (batch, maxk) bool, at most one hit per row since the top k are distinct classes
+        pred = output.topk(maxk, 1, largest=True, sorted=True).indices
+        correct = pred.eq(target.unsqueeze(1))
+        return [correct[:, :k].sum(dtype=torch.float32) for k in topk]
 
 
 if __name__ == '__main__':